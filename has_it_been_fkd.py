@@ -1,97 +1,325 @@
-from asyncio import gather, Semaphore, set_event_loop_policy, WindowsSelectorEventLoopPolicy, run
-from os import listdir
-from typing import Any
-from aiohttp import ClientSession
-from json import dumps, loads
+from asyncio import Condition, create_task, gather, Lock, Queue, set_event_loop_policy, run, sleep, TimeoutError, to_thread
+from collections import Counter
+from os import fsync, path
+from pathlib import Path
+from typing import Any, BinaryIO, Mapping
+from time import monotonic, time
+from aiohttp import ClientError, ClientSession, ClientTimeout
+from json import dumps
 from platform import system
-from re import compile, finditer
+from random import random
+from re import compile, Pattern
+from mmap import mmap, ACCESS_READ
 from aiohttp_proxy import ProxyConnector
 from rich.console import Console
-import aiofiles
+from yarl import URL
+import orjson
 
 console: Console = Console()
-breach_cache: dict[str: int] = {}
-
-
-async def gather_tasks(max_workers: int, *tasks) -> gather:
+MAX_RETRIES: int = 8
+MAX_BACKOFF: int = 60
+LOG_BATCH_SIZE: int = 50
+LOG_FLUSH_INTERVAL: float = 0.1
+log_queue: Queue = Queue()
+RESULTS_FILE: str = "results.jsonl"
+RESULTS_BATCH_SIZE: int = 500
+results_queue: Queue = Queue()
+breach_cache: Counter = Counter()
+email_regex: Pattern = compile(rb"([a-zA-Z0-9._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+)")
+
+HEADERS: dict[str: str] = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:107.0) Gecko/20100101 Firefox/107.0",
+    "Accept": "*/*",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Referer": "https://haveibeenpwned.com/",
+    "X-Requested-With": "XMLHttpRequest",
+    "DNT": "1",
+    "Connection": "keep-alive",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-origin",
+    "Sec-GPC": "1"
+}
+
+
+class Admission:
     """
-    Create semaphore for thread handling
-
-    :param max_workers: (int) - Max workers for semaphore
-    :param tasks: (coroutine) - Tasks to run through async semaphore
-    :return: (asyncio.gather)
+    Concurrency limiter whose ceiling shrinks on blocked requests & slowly grows back on successful ones
     """
-    semaphore = Semaphore(max_workers)
-
-    async def sem_task(task):
-        async with semaphore:
-            return await task
 
-    return await gather(*(sem_task(task) for task in tasks))
-
-
-async def count_breach(name) -> None:
+    def __init__(self, max_active: int) -> None:
+        """
+        :param max_active: (int) - Upper bound for concurrent requests
+        """
+        self.ceiling: int = max_active
+        self.max_active: int = max_active
+        self.active: int = 0
+        self.successes: int = 0
+        self.condition: Condition = Condition()
+
+    async def __aenter__(self) -> "Admission":
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.max_active)
+            self.active += 1
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify(1)
+
+    async def shrink(self) -> None:
+        """
+        Drop the concurrency limit by one (never below one) after a blocked request
+
+        :return: (None) -> None
+        """
+        async with self.condition:
+            self.max_active = max(1, self.max_active - 1)
+            self.successes = 0
+
+    async def record_success(self) -> None:
+        """
+        Count a successful request & raise the limit by one once a full window of them has gone through
+
+        :return: (None) -> None
+        """
+        async with self.condition:
+            self.successes += 1
+            if self.successes >= self.max_active and self.max_active < self.ceiling:
+                self.max_active += 1
+                self.successes = 0
+                self.condition.notify(1)
+
+
+class TokenBucket:
     """
-    Add a database & increment it in breach cache
-
-    :param name: (str) - Database name
-    :return: (None) -> None
+    Token bucket rate limiter whose refill rate follows the rate limit headers the server sends back
     """
-    try:
-        breach_cache[name] += 1
-    except KeyError:
-        breach_cache[name] = 1
-
 
-async def check_breaches(session: ClientSession, email_address: str) -> tuple[bool, list, int] | None:
+    def __init__(self, rate: float, burst: int) -> None:
+        """
+        :param rate: (float) - Max tokens (requests) refilled per second
+        :param burst: (int) - Max tokens the bucket can hold
+        """
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+            raise ValueError(f"requests_per_second must be a positive number, got {rate!r}")
+
+        self.max_rate: float = rate
+        self.min_rate: float = rate / 20
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = burst
+        self.last: float = monotonic()
+        self.lock: Lock = Lock()
+
+    async def take(self) -> None:
+        """
+        Wait until a token is available & consume it
+
+        :return: (None) -> None
+        """
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await sleep((1 - self.tokens) / self.rate)
+
+    def refill(self) -> None:
+        """
+        Credit the tokens earned since the last refill at the current rate
+
+        :return: (None) -> None
+        """
+        now: float = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def adjust(self, headers: Mapping[str, str], blocked: bool) -> None:
+        """
+        Retune the refill rate from a response's rate limit headers
+
+        :param headers: (Mapping[str, str]) - Response headers
+        :param blocked: (bool) - Whether the request got anything but a usable (200 / 404) response
+        :return: (None) -> None
+        """
+        remaining: str = headers.get("X-RateLimit-Remaining", "")
+        reset: str = headers.get("X-RateLimit-Reset", "")
+        retry_after: str = headers.get("Retry-After", "")
+
+        self.refill()
+
+        if remaining.isdigit() and reset.isdigit():
+            # Some servers send the reset as an epoch timestamp rather than seconds until reset
+            reset_in: float = int(reset) - time() if int(reset) > 10 ** 9 else int(reset)
+            self.rate = int(remaining) / max(1, reset_in)
+        elif blocked:
+            self.rate /= 2
+        else:
+            self.rate *= 1.05
+
+        self.rate = min(self.max_rate, max(self.min_rate, self.rate))
+
+        if retry_after.isdigit():
+            self.tokens = min(self.tokens, -min(MAX_BACKOFF, int(retry_after)) * self.rate)
+
+
+async def check_breaches(
+    session: ClientSession, admission: Admission, bucket: TokenBucket | None, email_address: str
+) -> tuple[bool, list, int] | None:
     """
     Get a list of data breaches an email is involved in and then add them to the breach cache
 
     :param session: (ClientSession) - Session you're running the requests on
+    :param admission: (Admission) - Limiter the request has to be admitted through
+    :param bucket: (TokenBucket | None) - Rate limiter the request has to take a token from, None for unlimited
     :param email_address: (str) - email_address
     :return: (tuple[bool, list, int]) - Breached (bool), Breaches (list), Breaches found (int)
     """
 
-    base_url: str = f"https://haveibeenpwned.com/unifiedsearch/{email_address.replace('@', '%40')}"
-    headers: dict[str: str] = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:107.0) Gecko/20100101 Firefox/107.0",
-        "Accept": "*/*",
-        "Accept-Language": "en-US,en;q=0.5",
-        "Referer": "https://haveibeenpwned.com/",
-        "X-Requested-With": "XMLHttpRequest",
-        "DNT": "1",
-        "Connection": "keep-alive",
-        "Sec-Fetch-Dest": "empty",
-        "Sec-Fetch-Mode": "cors",
-        "Sec-Fetch-Site": "same-origin",
-        "Sec-GPC": "1"
-    }
+    url: URL = URL.build(
+        scheme="https", host="haveibeenpwned.com", path=f"/unifiedsearch/{email_address.replace('@', '%40')}", encoded=True
+    )
+
+    output_data: dict = {"email": email_address, "databases": None, "database_list": [], "error": None}
+    last_failure: str | None = None
+
+    for attempt in range(MAX_RETRIES):
+        delay: float = min(MAX_BACKOFF, 2 ** attempt) + random()
+        if bucket:
+            await bucket.take()
+        try:
+            async with admission, session.get(url=url, headers=HEADERS) as lookup:
+                prefix: str = "[green bold]BREACHED!"
+                body: bytes = await lookup.read()
+                last_failure = f"status {lookup.status}"
+                if bucket:
+                    bucket.adjust(lookup.headers, lookup.status not in (200, 404))
+
+                match lookup.status:
+                    case 429 | 433:
+                        prefix = '[red bold]CLOUDFLARE!' if (b'Cloudflare to restrict access' in body) else '[red bold]RATELIMIT!'
+                        log_queue.put_nowait(f"{prefix} [white]Blocked [magenta bold]request [white]for [cyan]{email_address} [white](attempt {attempt + 1}/{MAX_RETRIES})")
+                        retry_after: str = lookup.headers.get("Retry-After", "")
+                        delay = min(MAX_BACKOFF, int(retry_after)) if retry_after.isdigit() else delay
+                        await admission.shrink()
+
+                    case 404:
+                        prefix = "[red bold]NO BREACHES!"
+                        log_queue.put_nowait(f"{prefix} [cyan]{email_address} [white]has not been found in any public data breaches.")
+                        results_queue.put_nowait(output_data)
+                        await admission.record_success()
+                        return
+
+                    case 200:
+                        data = orjson.loads(body)
+                        data_breaches: str = data["Breaches"]
+
+                        names: list[str] = [database["Name"] for database in data_breaches]
+                        breach_cache.update(names)
+
+                        output_data["databases"] = len(names)
+                        output_data["database_list"] = names
+                        results_queue.put_nowait(output_data)
+                        await admission.record_success()
+
+                        log_queue.put_nowait(f"{prefix} [cyan]{email_address} [white]has been found in [green bold]{output_data['databases']:,} databases[white]!")
+                        return True, names, len(names)
+
+                    case status if 400 <= status < 500 and status not in (403, 408):
+                        log_queue.put_nowait(f"[red bold]HTTP {status}! [white]Request rejected for [cyan]{email_address}")
+                        output_data["error"] = f"Request rejected (status {status})"
+                        results_queue.put_nowait(output_data)
+                        return
+
+                    case _:
+                        log_queue.put_nowait(f"[red bold]HTTP {lookup.status}! [white]Unexpected response for [cyan]{email_address} [white](attempt {attempt + 1}/{MAX_RETRIES})")
+        except (ClientError, TimeoutError) as error:
+            last_failure = repr(error)
+            log_queue.put_nowait(f"[red bold]ERROR! [white]Request failed for [cyan]{email_address} [white]({error!r}, attempt {attempt + 1}/{MAX_RETRIES})")
+
+        if attempt < MAX_RETRIES - 1:
+            await sleep(delay)
+
+    log_queue.put_nowait(f"[red bold]GAVE UP! [white]No usable response after {MAX_RETRIES} attempts for [cyan]{email_address}")
+    output_data["error"] = f"No usable response after {MAX_RETRIES} attempts (last failure: {last_failure})"
+    results_queue.put_nowait(output_data)
+
+
+async def worker(session: ClientSession, admission: Admission, bucket: TokenBucket | None, queue: Queue) -> None:
+    """
+    Pull emails off the queue and check them until cancelled
 
-    async with session.get(url=base_url, headers=headers) as lookup:
-        prefix: str = "[green bold]BREACHED!"
-        output_data: dict = {"email": email_address, "databases": None, "database_list": []}
+    :param session: (ClientSession) - Session you're running the requests on
+    :param admission: (Admission) - Limiter shared by every worker
+    :param bucket: (TokenBucket | None) - Rate limiter shared by every worker, None for unlimited
+    :param queue: (Queue) - Queue of emails waiting to be checked
+    :return: (None) -> None
+    """
+    while True:
+        mail: str = await queue.get()
+        try:
+            await check_breaches(session, admission, bucket, mail)
+        except Exception as error:
+            log_queue.put_nowait(f"[red bold]ERROR! [white]Request failed for [cyan]{mail} [white]({error!r})")
+            results_queue.put_nowait({"email": mail, "databases": None, "database_list": [], "error": repr(error)})
+        finally:
+            queue.task_done()
+
+
+async def log_writer(queue: Queue) -> None:
+    """
+    Drain queued log messages and write them to the console in batches
 
-        match lookup.status:
-            case 429 | 433:
-                prefix = '[red bold]CLOUDFLARE!' if ('Cloudflare to restrict access' in await lookup.text()) else '[red bold]RATELIMIT!'
-                console.log(f"{prefix} [white]Blocked [magenta bold]request [white]for [cyan]{email_address}")
-                return await check_breaches(session, email_address)
+    :param queue: (Queue) - Queue of rich markup messages
+    :return: (None) -> None
+    """
+    while True:
+        batch: list[str] = [await queue.get()]
+        while not queue.empty() and len(batch) < LOG_BATCH_SIZE:
+            batch.append(queue.get_nowait())
 
-            case 404:
-                prefix = "[red bold]NO BREACHES!"
-                console.log(f"{prefix} [cyan]{email_address} [white]has not been found in any public data breaches.")
-                return
+        console.log("\n".join(batch))
+        for _ in batch:
+            queue.task_done()
 
-        data = await lookup.json()
-        data_breaches: str = data["Breaches"]
+        if len(batch) < LOG_BATCH_SIZE:
+            await sleep(LOG_FLUSH_INTERVAL)
 
-        [await count_breach(database["Name"]) for database in data_breaches]
 
-        output_data["databases"] = len(data_breaches)
-        output_data["database_list"] = [database["Name"] for database in data_breaches]
+async def results_writer(queue: Queue, file: BinaryIO) -> None:
+    """
+    Drain queued results and append them to the results file as JSON lines
 
-        console.log(f"{prefix} [cyan]{email_address} [white]has been found in [green bold]{output_data['databases']:,} databases[white]!")
-        return True, [db['Name'] for db in data_breaches], len(data_breaches)
+    :param queue: (Queue) - Queue of output data dicts
+    :param file: (BinaryIO) - Results file opened for binary appending
+    :return: (None) -> None
+    """
+    while True:
+        batch: list[dict] = [await queue.get()]
+        while not queue.empty() and len(batch) < RESULTS_BATCH_SIZE:
+            batch.append(queue.get_nowait())
+
+        file.write(b"".join(orjson.dumps(result) + b"\n" for result in batch))
+        for _ in batch:
+            queue.task_done()
+
+
+def read_emails(file_name: str) -> list[str]:
+    """
+    Memory-map the input file and pull every unique email address out of it
+
+    :param file_name: (str) - Path of the input file
+    :return: (list[str]) - Unique emails found in the file, in order of first appearance
+    """
+    if not path.getsize(file_name):
+        return []
+
+    with open(file_name, "rb") as file, mmap(file.fileno(), 0, access=ACCESS_READ) as mapped:
+        return list(dict.fromkeys(mail.group(0).decode() for mail in email_regex.finditer(mapped)))
 
 
 async def load_files() -> tuple[list[str], dict]:
@@ -103,22 +331,20 @@ async def load_files() -> tuple[list[str], dict]:
 
     console.rule("File Loader")
 
-    config: dict = {'thread_count': 50, 'file_name': 'input_emails.txt', 'rotating_proxy': ''}
+    config: dict = {'thread_count': 50, 'requests_per_second': None, 'file_name': 'input_emails.txt', 'rotating_proxy': ''}
     config_name: str = "config.json"
 
     def create_file(file_name: str, file_contents: Any) -> None:
         open(file_name, "a").write(file_contents)
         console.log(f'[green bold]Created file "{file_name}"!')
     
-    if config_name not in listdir(): create_file(config_name, dumps(config, indent=4))
-    if config["file_name"] not in listdir(): create_file(config["file_name"], "")
+    if not path.exists(config_name): create_file(config_name, dumps(config, indent=4))
+    if not path.exists(config["file_name"]): create_file(config["file_name"], "")
 
-    async with aiofiles.open(config["file_name"], "r") as file:
-        email_regex = compile(r"([a-zA-Z0-9._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+)")
-        lines = [mail.group(0) for mail in finditer(email_regex, "\n".join(await file.readlines()))]
+    lines: list[str] = await to_thread(read_emails, config["file_name"])
 
-    console.log(f"[cyan]{len(lines):,} emails [white]loaded from input file.")
-    return lines, loads(open(config_name, "r").read())
+    console.log(f"[cyan]{len(lines):,} unique emails [white]loaded from input file.")
+    return lines, orjson.loads(Path(config_name).read_bytes())
 
 
 async def execute() -> None:
@@ -127,18 +353,59 @@ async def execute() -> None:
     console.log(f"[white]Config loaded! [red bold]{configuration}")
     console.rule("Starting Checking Process...")
 
-    connector = ProxyConnector.from_url(configuration["rotating_proxy"])
-    async with ClientSession(connector=connector) as client_session:
-        await gather_tasks(configuration["thread_count"], *[check_breaches(client_session, mail) for mail in lines])
+    thread_count: int = configuration["thread_count"]
+    requests_per_second: float | None = configuration.get("requests_per_second")
+    bucket: TokenBucket | None = TokenBucket(requests_per_second, thread_count) if requests_per_second is not None else None
+    connector = ProxyConnector.from_url(
+        configuration["rotating_proxy"],
+        limit=thread_count,
+        limit_per_host=thread_count,
+        ttl_dns_cache=600,
+        keepalive_timeout=75,
+        force_close=False,
+        enable_cleanup_closed=True
+    )
+    timeout: ClientTimeout = ClientTimeout(total=30, connect=10)
+
+    queue: Queue = Queue()
+    for mail in lines:
+        queue.put_nowait(mail)
+
+    with open(RESULTS_FILE, "ab") as results_file:
+        writers = [create_task(log_writer(log_queue)), create_task(results_writer(results_queue, results_file))]
+        async with ClientSession(connector=connector, timeout=timeout) as client_session:
+            admission: Admission = Admission(thread_count)
+            workers = [create_task(worker(client_session, admission, bucket, queue)) for _ in range(thread_count)]
+            await queue.join()
+
+            for task in workers:
+                task.cancel()
+            await gather(*workers, return_exceptions=True)
+
+        await log_queue.join()
+        await results_queue.join()
+        for task in writers:
+            task.cancel()
+        await gather(*writers, return_exceptions=True)
+
+        results_file.flush()
+        fsync(results_file.fileno())
+
+    console.log(f"[white]Results written to [cyan]{RESULTS_FILE}")
 
     console.rule(title="Data Breach Stats")
-    sorted_cache = {name: count for name, count in sorted(breach_cache.items(), key=lambda i: i[1], reverse=True)}
-
-    console.print(sorted_cache)
+    console.print(dict(breach_cache.most_common()))
 
 
 if __name__ == "__main__":
     if system() == 'Windows':
+        from asyncio import WindowsSelectorEventLoopPolicy
         set_event_loop_policy(WindowsSelectorEventLoopPolicy())
+    else:
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
 
     run(execute())